@@ -1,7 +1,7 @@
 package main
 
 import (
-	"errors"
+	"io"
 	"sync"
 	"time"
 )
@@ -62,6 +62,22 @@ const (
 	ebmlTagTagBinary       = 0x4485
 )
 
+const (
+	// The most `Broadcast.ReadFrom` requests from the reader at a time. The buffer is
+	// reallocated when it has less free space than that.
+	broadcastReadSize = 16384
+	// How much space `Broadcast.ReadFrom` allocates when the buffer runs out. This
+	// should fit many reads, as each allocation can only be reused for new data.
+	broadcastBufferSize = broadcastReadSize * 16
+)
+
+// Returned by `Broadcast.Write` and `Broadcast.ReadFrom` when the stream is not a valid WebM.
+type ebmlError string
+
+func (e ebmlError) Error() string {
+	return string(e)
+}
+
 var ebmlIndeterminateCoding = [...]uint64{
 	0, // these values in the "length" field all decode to `ebmlIndeterminate`.
 	0xFF,
@@ -74,6 +90,18 @@ var ebmlIndeterminateCoding = [...]uint64{
 	0x01FFFFFFFFFFFFFF,
 }
 
+// The number of bytes in a variable-length integer, indexed by its first byte.
+// (That is, 1 + the number of leading zero bits; 0 is not a valid first byte.)
+var ebmlVarintLength = func() (table [256]int) {
+	for i := 1; i < 256; i++ {
+		table[i] = 9
+		for b := i; b != 0; b >>= 1 {
+			table[i] -= 1
+		}
+	}
+	return
+}()
+
 func fixedUint(data []byte) uint64 {
 	var x uint64 = 0
 	for _, b := range data {
@@ -90,11 +118,7 @@ func ebmlTagID(data []byte) (uint64, int) {
 		// ...
 		// 00000001 xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx
 		//        ^---- this length marker is included in tag ids but not in other ints
-		consumed := 9
-		for b := data[0]; b != 0; b >>= 1 {
-			consumed -= 1
-		}
-		if len(data) >= consumed {
+		if consumed := ebmlVarintLength[data[0]]; len(data) >= consumed {
 			return fixedUint(data[:consumed]), consumed
 		}
 	}
@@ -182,9 +206,9 @@ func (fb *framebuffer) Read(cb func(cluster []byte, forceCluster bool, packed fr
 }
 
 type viewer struct {
-	// This function may return `false` to signal that it cannot write any more data.
-	// The stream will resynchronize at next keyframe.
-	write func(data []byte) bool
+	ch chan<- []byte
+	// Set when `ch` has overflowed; cleared once it is at most half full.
+	blocked bool
 	// Viewers may hop between streams, but should only receive headers once.
 	// This includes track info, as codecs must stay the same between segments.
 	skipHeaders bool
@@ -196,6 +220,18 @@ type viewer struct {
 	seenKeyframes uint32
 }
 
+// This function may return `false` to signal that it cannot write any more data.
+// The stream will resynchronize at next keyframe.
+func (cb *viewer) write(data []byte) bool {
+	// `Broadcast.Write` emits data in block-sized chunks.
+	// Thus the buffer size is measured in frames, not bytes.
+	cb.blocked = len(cb.ch) == cap(cb.ch) || (cb.blocked && len(cb.ch)*2 >= cap(cb.ch))
+	if !cb.blocked {
+		cb.ch <- data
+	}
+	return !cb.blocked
+}
+
 func (cb *viewer) WriteFrame(cluster []byte, forceCluster bool, packed frame) {
 	trackMask := uint32(1) << packed.track
 	if forceCluster {
@@ -215,7 +251,7 @@ func (cb *viewer) WriteFrame(cluster []byte, forceCluster bool, packed frame) {
 }
 
 type BroadcastSet struct {
-	mutex   sync.Mutex
+	mutex   sync.RWMutex
 	streams map[string]*Broadcast
 	// How long to keep a stream alive after a call to `Close`.
 	Timeout time.Duration
@@ -226,9 +262,13 @@ type BroadcastSet struct {
 
 type Broadcast struct {
 	StreamTrackInfo
-	closing time.Duration
-	Closed  bool
-	dirty   bool // (Has unseen data in `StreamTrackInfo`.)
+	set *BroadcastSet
+	id  string
+	// Started by `Close`, stopped by `Writable`; nil while the stream has a writer.
+	// Protected by `BroadcastSet.mutex`.
+	closing *time.Timer
+	done    chan struct{} // Closed after the stream is destroyed.
+	dirty   bool          // (Has unseen data in `StreamTrackInfo`.)
 	buffer  []byte
 	header  []byte // The EBML (DocType) tag.
 	tracks  []byte // The beginning of the Segment (Tracks + Info).
@@ -238,6 +278,7 @@ type Broadcast struct {
 	firstBlockInSegment bool
 	sentTimecode        uint64
 	sentClusterTimecode uint64
+	cluster             []byte // The header of the Cluster with `sentClusterTimecode`.
 	recvClusterTimecode uint64
 	timecodeShift       uint64
 	// these values are for the whole stream, so they include audio and muxing overhead.
@@ -252,12 +293,10 @@ type Broadcast struct {
 }
 
 func (ctx *BroadcastSet) Readable(id string) (*Broadcast, bool) {
-	if ctx.streams == nil {
-		return nil, false
-	}
-	ctx.mutex.Lock()
+	// Looking up a missing key in a nil map is fine, no need to check for that.
+	ctx.mutex.RLock()
 	cast, ok := ctx.streams[id]
-	ctx.mutex.Unlock()
+	ctx.mutex.RUnlock()
 	return cast, ok
 }
 
@@ -268,14 +307,18 @@ func (ctx *BroadcastSet) Writable(id string) (*Broadcast, bool) {
 		ctx.streams = make(map[string]*Broadcast)
 	}
 	if cast, ok := ctx.streams[id]; ok {
-		if cast.closing == -1 {
+		if cast.closing == nil {
 			return nil, false
 		}
-		cast.closing = -1
+		// If the timer has already fired, it will see that it's been superseded.
+		cast.closing.Stop()
+		cast.closing = nil
 		return cast, true
 	}
 	cast := Broadcast{
-		closing:             -1,
+		set:                 ctx,
+		id:                  id,
+		done:                make(chan struct{}),
 		frames:              framebuffer{make([]frame, 0, 120), 0, nil},
 		viewers:             make(map[chan<- []byte]*viewer),
 		sentClusterTimecode: 0xFFFFFFFFFFFFFFFF,
@@ -283,16 +326,17 @@ func (ctx *BroadcastSet) Writable(id string) (*Broadcast, bool) {
 	ctx.streams[id] = &cast
 	go func() {
 		ticker := time.NewTicker(time.Second)
-		for range ticker.C {
+		defer ticker.Stop()
+		for {
+			select {
+			case <-cast.done:
+				return
+			case <-ticker.C:
+			}
 			if cast.dirty {
 				cast.dirty = false
 				ctx.OnStreamTrackInfo(id, &cast.StreamTrackInfo)
 			}
-			if cast.closing >= 0 {
-				if cast.closing += time.Second; cast.closing > ctx.Timeout {
-					break
-				}
-			}
 			// exponentially weighted moving moments at a = 0.5
 			//     avg[n] = a * x + (1 - a) * avg[n - 1]
 			//     var[n] = a * (x - avg[n]) ** 2 / (1 - a) + (1 - a) * var[n - 1]
@@ -300,43 +344,42 @@ func (ctx *BroadcastSet) Writable(id string) (*Broadcast, bool) {
 			cast.RateVar += cast.rateUnit*cast.rateUnit - cast.RateVar/2
 			cast.rateUnit = -cast.RateMean
 		}
-		ticker.Stop()
+	}()
+	return &cast, true
+}
 
+// Destroy the stream after `BroadcastSet.Timeout` unless `Writable` is called again.
+func (cast *Broadcast) Close() error {
+	ctx := cast.set
+	ctx.mutex.Lock()
+	defer ctx.mutex.Unlock()
+	var timer *time.Timer
+	timer = time.AfterFunc(ctx.Timeout, func() {
 		ctx.mutex.Lock()
-		delete(ctx.streams, id)
-		ctx.mutex.Unlock()
-		cast.Closed = true
-		cast.vlock.Lock()
-		for _, cb := range cast.viewers {
-			cb.write([]byte{})
+		if cast.closing != timer {
+			ctx.mutex.Unlock()
+			return
 		}
-		cast.vlock.Unlock()
+		delete(ctx.streams, cast.id)
+		ctx.mutex.Unlock()
+		close(cast.done)
 		if ctx.OnStreamClose != nil {
-			ctx.OnStreamClose(id)
+			ctx.OnStreamClose(cast.id)
 		}
-	}()
-	return &cast, true
+	})
+	cast.closing = timer
+	return nil
 }
 
-func (cast *Broadcast) Close() error {
-	cast.closing = 0
-	return nil
+// Returns a channel that is closed when the stream ends and no more data will be sent
+// to connected viewers.
+func (cast *Broadcast) Done() <-chan struct{} {
+	return cast.done
 }
 
 func (cast *Broadcast) Connect(ch chan<- []byte, skipHeaders bool) {
-	blocked := false
-	write := func(data []byte) bool {
-		// `Broadcast.Write` emits data in block-sized chunks.
-		// Thus the buffer size is measured in frames, not bytes.
-		blocked = len(ch) == cap(ch) || (blocked && len(ch)*2 >= cap(ch))
-		if !blocked {
-			ch <- data
-		}
-		return !blocked
-	}
-
 	cast.vlock.Lock()
-	cast.viewers[ch] = &viewer{write: write}
+	cast.viewers[ch] = &viewer{ch: ch, skipHeaders: skipHeaders}
 	cast.vlock.Unlock()
 }
 
@@ -353,12 +396,50 @@ func (cast *Broadcast) Reset() {
 func (cast *Broadcast) Write(data []byte) (int, error) {
 	cast.rateUnit += float64(len(data))
 	cast.buffer = append(cast.buffer, data...)
+	if err := cast.parse(); err != nil {
+		return 0, err
+	}
+	return len(data), nil
+}
 
+// Same as `Write`, but reads the data directly into the internal buffer instead of
+// copying it from an intermediate one. Reads until EOF or an error; malformed data
+// results in an `ebmlError`, anything else came from the reader.
+func (cast *Broadcast) ReadFrom(r io.Reader) (int64, error) {
+	total := int64(0)
+	for {
+		if cap(cast.buffer)-len(cast.buffer) < broadcastReadSize {
+			// Sent frames still point into the old array, so only the unparsed tail can be moved.
+			// That tail may be an incomplete block of up to 1 MB, hence exponential growth.
+			buffer := make([]byte, len(cast.buffer), 2*len(cast.buffer)+broadcastBufferSize)
+			copy(buffer, cast.buffer)
+			cast.buffer = buffer
+		}
+		end := len(cast.buffer) + broadcastReadSize
+		n, err := r.Read(cast.buffer[len(cast.buffer):end])
+		if n != 0 {
+			total += int64(n)
+			cast.rateUnit += float64(n)
+			cast.buffer = cast.buffer[:len(cast.buffer)+n]
+			if err := cast.parse(); err != nil {
+				return total, err
+			}
+		}
+		if err == io.EOF {
+			return total, nil
+		}
+		if err != nil {
+			return total, err
+		}
+	}
+}
+
+func (cast *Broadcast) parse() error {
 	for {
 		buf := cast.buffer
 		tag := ebmlParseTagIncomplete(buf)
 		if tag.Consumed == 0 {
-			return len(data), nil
+			return nil
 		}
 
 		if tag.ID == ebmlTagSegment || tag.ID == ebmlTagTracks || tag.ID == ebmlTagCluster {
@@ -366,15 +447,15 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 			buf = buf[:tag.Consumed]
 		} else {
 			if tag.Length == ebmlIndeterminate {
-				return 0, errors.New("exact length required for all tags but Segments and Clusters")
+				return ebmlError("exact length required for all tags but Segments and Clusters")
 			}
 			total := tag.Length + uint64(tag.Consumed)
 			if total > 1024*1024 {
-				return 0, errors.New("data block too big")
+				return ebmlError("data block too big")
 			}
 
 			if total > uint64(len(buf)) {
-				return len(data), nil
+				return nil
 			}
 
 			buf = buf[:total]
@@ -421,13 +502,13 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 
 				switch tag2.ID {
 				case 0:
-					return 0, errors.New("malformed EBML")
+					return ebmlError("malformed EBML")
 
 				case ebmlTagDuration:
 					// Live streams must not have a duration.
 					void := tag2.Length + uint64(tag2.Consumed) - 2
 					if void > 0x7F {
-						return 0, errors.New("EBML Duration too large")
+						return ebmlError("EBML Duration too large")
 					}
 					buf2[0] = ebmlTagVoid
 					buf2[1] = 0x80 | byte(void)
@@ -440,7 +521,7 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 			}
 
 			if scale != 1000000 {
-				return 0, errors.New("invalid timecode scale")
+				return ebmlError("invalid timecode scale")
 			}
 
 			cast.tracks = append(cast.tracks, buf...)
@@ -451,12 +532,12 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 
 				switch tag2.ID {
 				case 0:
-					return 0, errors.New("malformed EBML")
+					return ebmlError("malformed EBML")
 
 				case ebmlTagTrackNumber:
 					// `viewer.seenKeyframes` is a 32-bit vector.
 					if fixedUint(tag2.Contents(buf2)) >= 32 {
-						return 0, errors.New("too many tracks")
+						return ebmlError("too many tracks")
 					}
 
 				case ebmlTagAudio:
@@ -469,7 +550,7 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 
 						switch tag3.ID {
 						case 0:
-							return 0, errors.New("malformed EBML")
+							return ebmlError("malformed EBML")
 
 						case ebmlTagPixelWidth:
 							cast.Width = uint(fixedUint(tag3.Contents(buf3)))
@@ -506,7 +587,7 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 
 					switch tag2.ID {
 					case 0:
-						return 0, errors.New("malformed EBML")
+						return ebmlError("malformed EBML")
 
 					case ebmlTagBlock:
 						block = tag2.Contents(buf2)
@@ -520,13 +601,13 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 				}
 
 				if block == nil {
-					return 0, errors.New("a BlockGroup contains no Blocks")
+					return ebmlError("a BlockGroup contains no Blocks")
 				}
 			}
 
 			track, consumed := ebmlUint(block)
 			if consumed == 0 || track >= 32 || len(block) < consumed+3 {
-				return 0, errors.New("invalid track")
+				return ebmlError("invalid track")
 			}
 			// This bit is always 0 in a Block, but 1 in a keyframe SimpleBlock.
 			key = key || block[consumed+2]&0x80 != 0
@@ -545,17 +626,22 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 			}
 
 			ctc := cast.recvClusterTimecode
-			cluster := []byte{
-				// indeterminate length cluster
-				ebmlTagCluster >> 24 & 0xFF, ebmlTagCluster >> 16 & 0xFF, ebmlTagCluster >> 8 & 0xFF, ebmlTagCluster & 0xFF, 0xFF,
-				// first child: 8-byte timecode
-				ebmlTagTimecode, 0x88,
-				byte(ctc >> 56), byte(ctc >> 48), byte(ctc >> 40), byte(ctc >> 32),
-				byte(ctc >> 24), byte(ctc >> 16), byte(ctc >> 8), byte(ctc),
+			forceCluster := ctc != cast.sentClusterTimecode
+			if forceCluster {
+				// Most blocks share a cluster with the previous one, so there's no need
+				// to allocate a new header for each of them.
+				cast.cluster = []byte{
+					// indeterminate length cluster
+					ebmlTagCluster >> 24 & 0xFF, ebmlTagCluster >> 16 & 0xFF, ebmlTagCluster >> 8 & 0xFF, ebmlTagCluster & 0xFF, 0xFF,
+					// first child: 8-byte timecode
+					ebmlTagTimecode, 0x88,
+					byte(ctc >> 56), byte(ctc >> 48), byte(ctc >> 40), byte(ctc >> 32),
+					byte(ctc >> 24), byte(ctc >> 16), byte(ctc >> 8), byte(ctc),
+				}
 			}
+			cluster := cast.cluster
 			packed := frame{buf, track, key}
 
-			forceCluster := ctc != cast.sentClusterTimecode
 			cast.vlock.Lock()
 			for _, cb := range cast.viewers {
 				if !cb.skipHeaders {
@@ -576,7 +662,7 @@ func (cast *Broadcast) Write(data []byte) (int, error) {
 			cast.firstBlockInSegment = false
 
 		default:
-			return 0, errors.New("unknown EBML tag")
+			return ebmlError("unknown EBML tag")
 		}
 
 		cast.buffer = cast.buffer[len(buf):]
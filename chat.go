@@ -55,7 +55,7 @@ func (q *ChatMessageQueue) Iterate(f func(x ChatMessage) error) error {
 
 func NewChat(qsize int) *Chat {
 	ctx := &Chat{
-		events:  make(chan interface{}),
+		events:  make(chan interface{}, 64),
 		Users:   make(map[*chatter]struct{}),
 		History: ChatMessageQueue{make([]ChatMessage, 0, qsize), 0},
 	}
@@ -63,8 +63,14 @@ func NewChat(qsize int) *Chat {
 	return ctx
 }
 
+// How many events may be handled after a change in the number of viewers
+// before the new count is announced, even if more (dis)connections are queued.
+const chatMaxHeldEvents = 32
+
 func (c *Chat) handle() {
 	closed := false
+	countChanged := false
+	countHeldFor := 0
 	for genericEvent := range c.events {
 		switch event := genericEvent.(type) {
 		case nil:
@@ -85,9 +91,7 @@ func (c *Chat) handle() {
 			} else {
 				c.Users[event] = struct{}{}
 			}
-			for u := range c.Users {
-				u.pushViewerCount()
-			}
+			countChanged = true
 
 		case ChatMessage:
 			c.History.Push(event)
@@ -95,6 +99,20 @@ func (c *Chat) handle() {
 				u.pushMessage(event)
 			}
 		}
+
+		// Viewers tend to (dis)connect in bursts, e.g. when a stream starts or ends.
+		// Only the final count is interesting, and sending each intermediate one
+		// to everyone would take quadratic time. A busy chat may never have an empty
+		// queue, though, so don't hold the count back for more than a few events.
+		if countChanged {
+			if countHeldFor++; countHeldFor >= chatMaxHeldEvents || len(c.events) == 0 {
+				countChanged = false
+				countHeldFor = 0
+				for u := range c.Users {
+					u.pushViewerCount()
+				}
+			}
+		}
 	}
 }
 
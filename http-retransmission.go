@@ -33,6 +33,7 @@
 package main
 
 import (
+	"bufio"
 	"golang.org/x/net/websocket"
 	"log"
 	"net/http"
@@ -85,7 +86,7 @@ func (ctx *RetransmissionHandler) ServeHTTP(w http.ResponseWriter, r *http.Reque
 func wantsWebsocket(r *http.Request) bool {
 	if upgrade, ok := r.Header["Upgrade"]; ok {
 		for i := range upgrade {
-			if strings.ToLower(upgrade[i]) == "websocket" {
+			if strings.EqualFold(upgrade[i], "websocket") {
 				return true
 			}
 		}
@@ -93,6 +94,14 @@ func wantsWebsocket(r *http.Request) bool {
 	return false
 }
 
+// Sent with every raw WebM stream. The keys are already in canonical form, and `net/http`
+// does not modify the values, so these can be shared between all viewers.
+var streamHeaders = http.Header{
+	"Access-Control-Allow-Origin": {"*"},
+	"Cache-Control":               {"no-cache"},
+	"Content-Type":                {"video/webm"},
+}
+
 func (ctx *RetransmissionHandler) watch(w http.ResponseWriter, r *http.Request, id string) error {
 	if r.URL.RawQuery != "" {
 		return RenderError(w, http.StatusBadRequest, "Send WebMs here, watch using the other links.")
@@ -139,11 +148,14 @@ func (ctx *RetransmissionHandler) watch(w http.ResponseWriter, r *http.Request,
 	}
 
 	header := w.Header()
-	header.Set("Access-Control-Allow-Origin", "*")
-	header.Set("Cache-Control", "no-cache")
-	header.Set("Content-Type", "video/webm")
+	for k, v := range streamHeaders {
+		header[k] = v
+	}
 	w.WriteHeader(http.StatusOK)
 	f, flushable := w.(http.Flusher)
+	// Most EBML elements are small, and `net/http` makes a separate chunk out of
+	// each large enough `Write`. Merging them saves on both framing and syscalls.
+	bw := bufio.NewWriterSize(w, 16384)
 
 	ch := make(chan []byte, 240)
 	defer close(ch)
@@ -151,15 +163,36 @@ func (ctx *RetransmissionHandler) watch(w http.ResponseWriter, r *http.Request,
 	stream.Connect(ch, false)
 	defer stream.Disconnect(ch)
 
-	for chunk := range ch {
-		if _, err := w.Write(chunk); err != nil || stream.Closed {
-			break
-		}
-		if flushable {
-			f.Flush()
+	// Without this, a viewer that went away would only be noticed at the next write,
+	// and a stalled stream may not have one for a while.
+	gone := r.Context().Done()
+	for {
+		select {
+		case chunk := <-ch:
+			// Chunks come in bursts (a cluster and a block, or the whole buffer if
+			// the viewer has just connected), so write out everything that's queued
+			// and only then flush.
+			for queued := len(ch); ; queued-- {
+				if _, err := bw.Write(chunk); err != nil {
+					return nil
+				}
+				if queued == 0 {
+					break
+				}
+				chunk = <-ch
+			}
+			if err := bw.Flush(); err != nil {
+				return nil
+			}
+			if flushable {
+				f.Flush()
+			}
+		case <-stream.Done():
+			return nil
+		case <-gone:
+			return nil
 		}
 	}
-	return nil
 }
 
 func (ctx *RetransmissionHandler) stream(w http.ResponseWriter, r *http.Request, id string) error {
@@ -181,18 +214,12 @@ func (ctx *RetransmissionHandler) stream(w http.ResponseWriter, r *http.Request,
 	}
 	defer stream.Close()
 
-	buffer := [16384]byte{}
-	for {
-		n, err := r.Body.Read(buffer[:])
-		if n != 0 {
-			if _, err := stream.Write(buffer[:n]); err != nil {
-				stream.Reset()
-				return RenderError(w, http.StatusBadRequest, err.Error())
-			}
-		}
-		if err != nil {
-			w.WriteHeader(http.StatusNoContent)
-			return nil
+	if _, err := stream.ReadFrom(r.Body); err != nil {
+		if _, ok := err.(ebmlError); ok {
+			stream.Reset()
+			return RenderError(w, http.StatusBadRequest, err.Error())
 		}
 	}
+	w.WriteHeader(http.StatusNoContent)
+	return nil
 }
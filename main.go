@@ -49,7 +49,9 @@ func main() {
 	bind := flag.String("bind", ":8000", "The network ([ip]:port) to bind on.")
 	addr := flag.String("addr", "", "The public address (host[:port]) of this node.")
 	ephemeral := flag.Bool("ephemeral", false, "Use a process-local in-memory userless database. Can only be enabled in joint mode.")
+	dev := flag.Bool("dev", false, "Reload templates when they are modified.")
 	flag.Parse()
+	templates.Reload = *dev
 
 	if *ephemeral && *addr != "" {
 		log.Fatal("-ephemeral cannot be used with -addr. Running as a part of a cluster requires coordination through a database.")
@@ -8,14 +8,19 @@ import (
 	"os"
 	"path/filepath"
 	"reflect"
-	"regexp"
+	"sync"
+	"text/template/parse"
 	"time"
 )
 
 type templateSet struct {
-	root  string
-	data  *template.Template
-	mtime time.Time
+	root      string
+	data      *template.Template
+	mtime     time.Time
+	cacheLock sync.Mutex
+	cache     map[viewmodel][]byte // See `RenderCached`.
+	// Whether to check for modified templates on each render. Costs a `stat` per page.
+	Reload bool
 }
 
 type viewmodel interface {
@@ -38,32 +43,146 @@ var templateFuncs = template.FuncMap{
 	},
 }
 
-var htmlInterElementWhitespace = regexp.MustCompile(">\\s+<")
+// Replace whitespace between tags with a single space; same as applying `s/>\s+</> </g`
+// to the whole document, but in one pass and with exactly one allocation.
+func collapseInterElementWhitespace(data []byte) []byte {
+	out := make([]byte, 0, len(data))
+	for i := 0; i < len(data); {
+		c := data[i]
+		out = append(out, c)
+		i++
+		if c == '>' {
+			j := i
+			for j < len(data) && (data[j] == ' ' || data[j] == '\t' || data[j] == '\n' || data[j] == '\f' || data[j] == '\r') {
+				j++
+			}
+			if j != i && j < len(data) && data[j] == '<' {
+				out = append(out, ' ')
+			} else {
+				out = append(out, data[i:j]...)
+			}
+			i = j
+		}
+	}
+	return out
+}
 
-func (ts *templateSet) Render(w http.ResponseWriter, code int, vm viewmodel) error {
-	name := vm.TemplateFile()
+// Apply `collapseInterElementWhitespace` to the static parts of a template in advance.
+// The output still has to be processed to handle whitespace around actions, but there's
+// less to execute and less to scan.
+func collapseTemplateWhitespace(node parse.Node) {
+	switch node := node.(type) {
+	case *parse.ListNode:
+		if node != nil {
+			for _, child := range node.Nodes {
+				collapseTemplateWhitespace(child)
+			}
+		}
+	case *parse.TextNode:
+		node.Text = collapseInterElementWhitespace(node.Text)
+	case *parse.IfNode:
+		collapseTemplateWhitespace(node.List)
+		collapseTemplateWhitespace(node.ElseList)
+	case *parse.RangeNode:
+		collapseTemplateWhitespace(node.List)
+		collapseTemplateWhitespace(node.ElseList)
+	case *parse.WithNode:
+		collapseTemplateWhitespace(node.List)
+		collapseTemplateWhitespace(node.ElseList)
+	}
+}
+
+func (ts *templateSet) reload(name string) error {
+	if ts.data != nil && !ts.Reload {
+		return nil
+	}
 	stat, err := os.Stat(filepath.Join(ts.root, name))
 	if ts.data == nil || (err == nil && stat.ModTime().After(ts.mtime)) {
-		ts.data, err = template.New(ts.root).Funcs(templateFuncs).ParseGlob(filepath.Join(ts.root, "*"))
+		data, err := template.New(ts.root).Funcs(templateFuncs).ParseGlob(filepath.Join(ts.root, "*"))
 		if err != nil {
 			return err
 		}
+		// Other requests may execute `ts.data` concurrently, so the new set must be
+		// fully prepared before it is published.
+		for _, t := range data.Templates() {
+			if t.Tree != nil {
+				collapseTemplateWhitespace(t.Tree.Root)
+			}
+		}
+		ts.data = data
 		ts.mtime = time.Now()
+		ts.cacheLock.Lock()
+		ts.cache = nil
+		ts.cacheLock.Unlock()
 	}
+	return nil
+}
+
+// Template output is always copied out by `collapseInterElementWhitespace`,
+// so the buffers it is executed into can be reused.
+var templateBuffers = sync.Pool{New: func() interface{} { return &bytes.Buffer{} }}
+
+func (ts *templateSet) execute(name string, vm viewmodel) ([]byte, error) {
 	if t := ts.data.Lookup(name); t != nil {
-		buf := &bytes.Buffer{}
-		if err = t.Execute(buf, vm); err != nil {
+		buf := templateBuffers.Get().(*bytes.Buffer)
+		defer templateBuffers.Put(buf)
+		buf.Reset()
+		if err := t.Execute(buf, vm); err != nil {
+			return nil, err
+		}
+		return collapseInterElementWhitespace(buf.Bytes()), nil
+	}
+	return nil, fmt.Errorf("template not found: %s", name)
+}
+
+func writeHTML(w http.ResponseWriter, code int, data []byte) {
+	w.Header().Set("Content-Type", "text/html; encoding=utf-8")
+	w.WriteHeader(code)
+	w.Write(data)
+}
+
+func (ts *templateSet) Render(w http.ResponseWriter, code int, vm viewmodel) error {
+	name := vm.TemplateFile()
+	if err := ts.reload(name); err != nil {
+		return err
+	}
+	data, err := ts.execute(name, vm)
+	if err != nil {
+		return err
+	}
+	writeHTML(w, code, data)
+	return nil
+}
+
+// Same as `Render`, but remembers the output until the templates are reloaded.
+// The viewmodel must be comparable, must not point to anything mutable, and should
+// come from a small set of possible values, as nothing is ever evicted.
+func (ts *templateSet) RenderCached(w http.ResponseWriter, code int, vm viewmodel) error {
+	name := vm.TemplateFile()
+	if err := ts.reload(name); err != nil {
+		return err
+	}
+	ts.cacheLock.Lock()
+	data, ok := ts.cache[vm]
+	ts.cacheLock.Unlock()
+	if !ok {
+		var err error
+		if data, err = ts.execute(name, vm); err != nil {
 			return err
 		}
-		w.Header().Set("Content-Type", "text/html; encoding=utf-8")
-		w.WriteHeader(code)
-		w.Write(htmlInterElementWhitespace.ReplaceAll(buf.Bytes(), []byte("> <")))
-		return nil
+		ts.cacheLock.Lock()
+		if ts.cache == nil {
+			ts.cache = make(map[viewmodel][]byte)
+		}
+		ts.cache[vm] = data
+		ts.cacheLock.Unlock()
 	}
-	return fmt.Errorf("template not found: %s", name)
+	writeHTML(w, code, data)
+	return nil
 }
 
-var Render = (&templateSet{root: "templates"}).Render
+var templates = &templateSet{root: "templates"}
+var Render = templates.Render
 
 type ErrorTemplate struct {
 	Code    int
@@ -112,6 +231,11 @@ func (e ErrorTemplate) DisplayComment() string {
 
 func RenderError(w http.ResponseWriter, code int, message string) error {
 	w.Header().Set("Cache-Control", "no-cache")
+	if message == "" {
+		// A page with the default message depends only on the code, and there
+		// aren't many of those. (Also, crawlers and scanners love 404s.)
+		return templates.RenderCached(w, code, ErrorTemplate{code, ""})
+	}
 	return Render(w, code, ErrorTemplate{code, message})
 }
 